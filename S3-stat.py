@@ -5,109 +5,320 @@ AWS S3 存储桶大小统计脚本
 注意：CloudWatch指标可能有24小时延迟
 """
 
+import json
+import math
+import threading
+import time
+from collections import defaultdict
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError, NoCredentialsError
-from datetime import datetime
+from datetime import datetime, timedelta
+from pathlib import Path
+
+# 并发处理存储桶的线程数（网络I/O密集型）
+MAX_WORKERS = 32
+
+# 所有客户端共享的配置：连接池大小与工作线程数匹配，复用长连接
+CLIENT_CONFIG = Config(
+    max_pool_connections=MAX_WORKERS,
+    retries={'mode': 'adaptive', 'max_attempts': 10},
+    tcp_keepalive=True
+)
+
+# CloudWatch限流错误码（客户端自适应重试会自动重试这些错误）
+THROTTLING_ERROR_CODES = {'Throttling', 'ThrottlingException', 'RequestLimitExceeded'}
+
+# 大小单位，按1024进位
+SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB')
+
+# GetMetricData单次请求的最大查询数
+MAX_METRIC_DATA_QUERIES = 500
+
+# 所有可能的存储类型
+STORAGE_TYPES = [
+    'StandardStorage',
+    'StandardIAStorage',  # Standard-IA
+    'IntelligentTieringFAStorage',  # Intelligent-Tiering
+    'IntelligentTieringIAStorage',
+    'IntelligentTieringAAStorage',
+    'IntelligentTieringAIAStorage',
+    'IntelligentTieringDAAStorage',
+    'OneZoneIAStorage',  # One Zone-IA
+    'ReducedRedundancyStorage',  # RRS
+    'GlacierInstantRetrievalStorage',  # Glacier Instant Retrieval
+    'GlacierStorage',  # Glacier Flexible Retrieval
+    'DeepArchiveStorage',  # Glacier Deep Archive
+    'GlacierStagingStorage',
+    'GlacierObjectOverhead',
+    'GlacierS3ObjectOverhead'
+]
+
+# GetBucketLocation返回的特殊LocationConstraint到区域名称的映射
+LOCATION_CONSTRAINT_REGIONS = {
+    None: 'us-east-1',
+    '': 'us-east-1',
+    'EU': 'eu-west-1'
+}
+
+# 存储桶区域的本地缓存文件（存储桶区域创建后不会改变）
+REGION_CACHE_FILE = Path.home() / '.cache' / 's3stat_regions.json'
+# 存储桶实际使用的存储类型的本地缓存文件及有效期（CloudWatch每天更新一次S3大小指标）
+STORAGE_TYPE_CACHE_FILE = Path.home() / '.cache' / 's3stat_storage_types.json'
+STORAGE_TYPE_CACHE_TTL = 86400
+
+# 每个线程独立的boto3 Session（Session不是线程安全的）
+_thread_local = threading.local()
+# 保护CloudWatch客户端字典的锁
+_cloudwatch_lock = threading.Lock()
+# 保护存储桶区域缓存的锁
+_region_cache_lock = threading.Lock()
+# 保护存储类型缓存的锁
+_storage_type_cache_lock = threading.Lock()
+
+
+def get_thread_session():
+    """
+    获取当前线程专用的boto3 Session
+    
+    Returns:
+        boto3.session.Session
+    """
+    session = getattr(_thread_local, 'session', None)
+    if session is None:
+        session = boto3.session.Session()
+        _thread_local.session = session
+    return session
+
+
+def get_thread_s3_client():
+    """
+    获取当前线程专用的S3客户端
+    
+    Returns:
+        boto3 S3客户端
+    """
+    s3_client = getattr(_thread_local, 's3_client', None)
+    if s3_client is None:
+        s3_client = get_thread_session().client('s3', config=CLIENT_CONFIG)
+        _thread_local.s3_client = s3_client
+    return s3_client
+
+
+def get_cloudwatch_client(cloudwatch_clients, region):
+    """
+    获取或创建指定区域的CloudWatch客户端（多线程共享，需加锁）
+    
+    Args:
+        cloudwatch_clients: CloudWatch客户端字典（按区域）
+        region: 区域名称
+        
+    Returns:
+        boto3 CloudWatch客户端
+    """
+    with _cloudwatch_lock:
+        if region not in cloudwatch_clients:
+            cloudwatch_clients[region] = get_thread_session().client(
+                'cloudwatch', region_name=region, config=CLIENT_CONFIG
+            )
+        return cloudwatch_clients[region]
+
+
+def load_json_cache(cache_file):
+    """
+    从本地JSON文件加载缓存
+    
+    Args:
+        cache_file: 缓存文件路径
+        
+    Returns:
+        缓存字典，文件不存在、无法解析或内容不是字典时为空字典
+    """
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
 
 
-def get_bucket_region(s3_client, bucket_name):
+def save_json_cache(cache_file, cache):
     """
-    获取存储桶所在的区域
+    将缓存写入本地JSON文件
+    
+    Args:
+        cache_file: 缓存文件路径
+        cache: 缓存字典
+    """
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(cache_file, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+    except OSError as e:
+        print(f"警告: 无法写入缓存文件 {cache_file}: {e}")
+
+
+def get_bucket_region(s3_client, bucket_name, region_cache):
+    """
+    获取存储桶所在的区域（优先使用缓存）
     
     Args:
         s3_client: boto3 S3客户端
         bucket_name: 存储桶名称
+        region_cache: {存储桶名称: 区域} 缓存字典
         
     Returns:
         区域名称
     """
-    try:
-        response = s3_client.get_bucket_location(Bucket=bucket_name)
-        # LocationConstraint为None表示us-east-1
-        region = response['LocationConstraint']
-        if region is None:
-            region = 'us-east-1'
+    with _region_cache_lock:
+        region = region_cache.get(bucket_name)
+    if region:
         return region
+    
+    # HeadBucket的响应头中带有区域，跨区域时的301/403错误响应中同样带有
+    try:
+        response = s3_client.head_bucket(Bucket=bucket_name)
+        headers = response['ResponseMetadata']['HTTPHeaders']
     except ClientError as e:
-        print(f"  警告: 无法获取存储桶 {bucket_name} 的区域: {e}")
-        return 'us-east-1'
+        headers = e.response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+    region = headers.get('x-amz-bucket-region')
+    
+    # 响应头缺失时回退到GetBucketLocation
+    if not region:
+        try:
+            response = s3_client.get_bucket_location(Bucket=bucket_name)
+            location = response['LocationConstraint']
+            region = LOCATION_CONSTRAINT_REGIONS.get(location, location)
+        except ClientError as e:
+            print(f"  警告: 无法获取存储桶 {bucket_name} 的区域: {e}")
+            return 'us-east-1'
+    
+    with _region_cache_lock:
+        region_cache[bucket_name] = region
+    return region
 
 
-def get_bucket_size(s3_client, bucket_name, bucket_region, cloudwatch_clients):
+def get_bucket_storage_types(cloudwatch_client, bucket_names, storage_type_cache):
     """
-    获取指定S3存储桶的大小（使用CloudWatch指标）
+    获取同一区域内各存储桶实际有数据的存储类型（优先使用缓存）
+    
+    缓存未命中或过期时，通过一次分页的ListMetrics列出该区域所有
+    BucketSizeBytes指标，并刷新该区域所有存储桶的缓存
     
     Args:
-        s3_client: boto3 S3客户端
-        bucket_name: 存储桶名称
-        bucket_region: 存储桶所在区域
-        cloudwatch_clients: CloudWatch客户端字典（按区域）
+        cloudwatch_client: 该区域的boto3 CloudWatch客户端
+        bucket_names: 该区域内的存储桶名称列表
+        storage_type_cache: {存储桶名称: {'storage_types': [...], 'updated': 时间戳}} 缓存字典
         
     Returns:
-        存储桶大小（字节）
+        {存储桶名称: 存储类型列表} 字典
     """
+    now = time.time()
+    with _storage_type_cache_lock:
+        entries = {name: storage_type_cache.get(name) for name in bucket_names}
+    # 条目缺失、格式不正确或已过期时都需要重新列出指标
+    if all(
+        isinstance(entry, dict)
+        and isinstance(entry.get('storage_types'), list)
+        and isinstance(entry.get('updated'), (int, float))
+        and now - entry['updated'] < STORAGE_TYPE_CACHE_TTL
+        for entry in entries.values()
+    ):
+        return {name: entry['storage_types'] for name, entry in entries.items()}
+    
+    bucket_storage_types = {bucket_name: set() for bucket_name in bucket_names}
     try:
-        from datetime import timedelta
-        
-        # 获取或创建该区域的CloudWatch客户端
-        if bucket_region not in cloudwatch_clients:
-            cloudwatch_clients[bucket_region] = boto3.client('cloudwatch', region_name=bucket_region)
-        
-        cloudwatch_client = cloudwatch_clients[bucket_region]
-        
-        # CloudWatch指标有延迟，查询过去3天的数据
-        end_time = datetime.now()
-        start_time = end_time - timedelta(days=3)
-        
-        # 所有可能的存储类型
-        storage_types = [
-            'StandardStorage',
-            'StandardIAStorage',  # Standard-IA
-            'IntelligentTieringFAStorage',  # Intelligent-Tiering
-            'IntelligentTieringIAStorage',
-            'IntelligentTieringAAStorage',
-            'IntelligentTieringAIAStorage',
-            'IntelligentTieringDAAStorage',
-            'OneZoneIAStorage',  # One Zone-IA
-            'ReducedRedundancyStorage',  # RRS
-            'GlacierInstantRetrievalStorage',  # Glacier Instant Retrieval
-            'GlacierStorage',  # Glacier Flexible Retrieval
-            'DeepArchiveStorage',  # Glacier Deep Archive
-            'GlacierStagingStorage',
-            'GlacierObjectOverhead',
-            'GlacierS3ObjectOverhead'
-        ]
-        
-        total_size = 0
+        paginator = cloudwatch_client.get_paginator('list_metrics')
+        pages = paginator.paginate(Namespace='AWS/S3', MetricName='BucketSizeBytes')
+        for page in pages:
+            for metric in page['Metrics']:
+                dimensions = {d['Name']: d['Value'] for d in metric['Dimensions']}
+                bucket_name = dimensions.get('BucketName')
+                storage_type = dimensions.get('StorageType')
+                if bucket_name in bucket_storage_types and storage_type in STORAGE_TYPES:
+                    bucket_storage_types[bucket_name].add(storage_type)
+    except ClientError as e:
+        # 无法列出指标时查询所有存储类型
+        print(f"  警告: 无法列出CloudWatch指标，将查询所有存储类型: {e}")
+        return {bucket_name: STORAGE_TYPES for bucket_name in bucket_names}
+    
+    # 保持与STORAGE_TYPES相同的顺序
+    result = {
+        bucket_name: [t for t in STORAGE_TYPES if t in storage_types]
+        for bucket_name, storage_types in bucket_storage_types.items()
+    }
+    with _storage_type_cache_lock:
+        for bucket_name, storage_types in result.items():
+            storage_type_cache[bucket_name] = {'storage_types': storage_types, 'updated': now}
+    return result
+
+
+def get_region_bucket_sizes(cloudwatch_client, bucket_storage_types):
+    """
+    批量获取同一区域内多个S3存储桶的大小（使用CloudWatch指标）
+    
+    为每个 (存储桶, 存储类型) 构建一个查询，按GetMetricData单次上限分块，
+    每块通过分页器获取全部结果
+    
+    Args:
+        cloudwatch_client: 该区域的boto3 CloudWatch客户端
+        bucket_storage_types: {存储桶名称: 需要查询的存储类型列表} 字典
         
+    Returns:
+        {存储桶名称: 大小（字节）} 字典
+    """
+    sizes = {bucket_name: 0 for bucket_name in bucket_storage_types}
+    
+    # CloudWatch指标有延迟，查询过去3天的数据
+    end_time = datetime.now()
+    start_time = end_time - timedelta(days=3)
+    
+    # 每个 (存储桶, 存储类型) 一个查询，Id 映射回存储桶
+    metric_data_queries = []
+    id_to_bucket = {}
+    for bucket_name, storage_types in bucket_storage_types.items():
         for storage_type in storage_types:
-            try:
-                response = cloudwatch_client.get_metric_statistics(
-                    Namespace='AWS/S3',
-                    MetricName='BucketSizeBytes',
-                    Dimensions=[
-                        {'Name': 'BucketName', 'Value': bucket_name},
-                        {'Name': 'StorageType', 'Value': storage_type}
-                    ],
-                    StartTime=start_time,
-                    EndTime=end_time,
-                    Period=86400,  # 24小时
-                    Statistics=['Average']
-                )
-                
-                if response['Datapoints']:
-                    # 获取最新的数据点
-                    datapoints = sorted(response['Datapoints'], key=lambda x: x['Timestamp'], reverse=True)
-                    if datapoints:
-                        total_size += datapoints[0]['Average']
-            except ClientError:
-                # 某些存储类型可能不适用，忽略错误
-                continue
-        
-        return total_size
-    except Exception as e:
-        print(f"  警告: 无法通过CloudWatch获取存储桶 {bucket_name} 的大小: {e}")
-        return 0
+            query_id = f"m{len(metric_data_queries)}"
+            id_to_bucket[query_id] = bucket_name
+            metric_data_queries.append({
+                'Id': query_id,
+                'MetricStat': {
+                    'Metric': {
+                        'Namespace': 'AWS/S3',
+                        'MetricName': 'BucketSizeBytes',
+                        'Dimensions': [
+                            {'Name': 'BucketName', 'Value': bucket_name},
+                            {'Name': 'StorageType', 'Value': storage_type}
+                        ]
+                    },
+                    'Period': 86400,  # 24小时
+                    'Stat': 'Average'
+                },
+                'ReturnData': True
+            })
+    
+    paginator = cloudwatch_client.get_paginator('get_metric_data')
+    latest = {}
+    for offset in range(0, len(metric_data_queries), MAX_METRIC_DATA_QUERIES):
+        pages = paginator.paginate(
+            MetricDataQueries=metric_data_queries[offset:offset + MAX_METRIC_DATA_QUERIES],
+            StartTime=start_time,
+            EndTime=end_time,
+            ScanBy='TimestampDescending'
+        )
+        for page in pages:
+            for result in page['MetricDataResults']:
+                # 按时间倒序返回，每个查询第一次出现的值即最新的数据点
+                if result['Values'] and result['Id'] not in latest:
+                    latest[result['Id']] = result['Values'][0]
+    
+    for query_id, value in latest.items():
+        sizes[id_to_bucket[query_id]] += value
+    
+    return sizes
 
 
 def format_size(size_bytes):
@@ -120,11 +331,51 @@ def format_size(size_bytes):
     Returns:
         格式化后的字符串
     """
-    for unit in ['B', 'KB', 'MB', 'GB', 'TB', 'PB']:
-        if size_bytes < 1024.0:
-            return f"{size_bytes:.2f} {unit}"
-        size_bytes /= 1024.0
-    return f"{size_bytes:.2f} EB"
+    # 每1024倍（2^10）进一个单位，直接由对数计算单位下标
+    i = min(len(SIZE_UNITS) - 1, int(math.log2(max(size_bytes, 1)) // 10))
+    return f"{size_bytes / (1 << (10 * i)):.2f} {SIZE_UNITS[i]}"
+
+
+def resolve_bucket_region(bucket_name, region_cache):
+    """
+    获取单个存储桶的区域（在工作线程中执行）
+    
+    Args:
+        bucket_name: 存储桶名称
+        region_cache: {存储桶名称: 区域} 缓存字典
+        
+    Returns:
+        区域名称
+    """
+    return get_bucket_region(get_thread_s3_client(), bucket_name, region_cache)
+
+
+def fetch_region_sizes(cloudwatch_clients, region, bucket_names, storage_type_cache):
+    """
+    获取一个区域内所有存储桶的大小（在工作线程中执行），失败时记为0
+    
+    Args:
+        cloudwatch_clients: CloudWatch客户端字典（按区域）
+        region: 区域名称
+        bucket_names: 该区域内的存储桶名称列表
+        storage_type_cache: 存储类型缓存字典
+        
+    Returns:
+        {存储桶名称: 大小（字节）} 字典
+    """
+    try:
+        cloudwatch_client = get_cloudwatch_client(cloudwatch_clients, region)
+        bucket_storage_types = get_bucket_storage_types(
+            cloudwatch_client, bucket_names, storage_type_cache
+        )
+        return get_region_bucket_sizes(cloudwatch_client, bucket_storage_types)
+    except Exception as e:
+        code = e.response.get('Error', {}).get('Code') if isinstance(e, ClientError) else None
+        if code in THROTTLING_ERROR_CODES:
+            print(f"  警告: 获取区域 {region} 的存储桶大小时持续被限流（重试后仍失败，按0计）: {e}")
+        else:
+            print(f"  警告: 无法通过CloudWatch获取区域 {region} 的存储桶大小（按0计）: {e}")
+        return {bucket_name: 0 for bucket_name in bucket_names}
 
 
 def main():
@@ -136,9 +387,16 @@ def main():
     
     try:
         # 创建AWS客户端
-        s3_client = boto3.client('s3')
+        s3_client = get_thread_session().client('s3', config=CLIENT_CONFIG)
         # CloudWatch客户端字典，按区域缓存
         cloudwatch_clients = {}
+        # 存储桶区域缓存，跨运行持久化
+        region_cache = {
+            name: region for name, region in load_json_cache(REGION_CACHE_FILE).items()
+            if isinstance(region, str) and region
+        }
+        # 存储桶存储类型缓存，24小时内有效
+        storage_type_cache = load_json_cache(STORAGE_TYPE_CACHE_FILE)
         
         # 获取所有存储桶列表
         print("正在获取所有S3存储桶列表...")
@@ -153,33 +411,62 @@ def main():
         
         total_size = 0
         bucket_sizes = []
+        # 按区域统计，在获取大小的同时累计
+        region_stats = {}
+        creation_dates = {bucket['Name']: bucket['CreationDate'] for bucket in buckets}
         
         print("使用CloudWatch指标获取存储桶大小...")
         print("注意：CloudWatch指标可能有24小时延迟\n")
         
-        # 统计每个存储桶的大小
-        for i, bucket in enumerate(buckets, 1):
-            bucket_name = bucket['Name']
-            print(f"[{i}/{len(buckets)}] 正在处理: {bucket_name}")
-            
-            # 获取存储桶所在区域
-            bucket_region = get_bucket_region(s3_client, bucket_name)
-            print(f"  区域: {bucket_region}")
-            
-            # 使用CloudWatch方法（自动使用对应区域的客户端）
-            size = get_bucket_size(s3_client, bucket_name, bucket_region, cloudwatch_clients)
-            
-            bucket_sizes.append({
-                'name': bucket_name,
-                'size': size,
-                'region': bucket_region,
-                'created': bucket['CreationDate']
-            })
-            total_size += size
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            # 并发获取每个存储桶所在区域，并按区域分组
+            region_to_buckets = defaultdict(list)
+            futures = {
+                executor.submit(resolve_bucket_region, bucket['Name'], region_cache): bucket['Name']
+                for bucket in buckets
+            }
+            for i, future in enumerate(as_completed(futures), 1):
+                bucket_name = futures[future]
+                bucket_region = future.result()
+                region_to_buckets[bucket_region].append(bucket_name)
+                print(f"[{i}/{len(buckets)}] {bucket_name}  区域: {bucket_region}")
+            print()
             
-            print(f"  大小: {format_size(size)}")
+            # 每个区域批量查询CloudWatch，各区域并发执行，结果返回时直接汇总
+            futures = {
+                executor.submit(
+                    fetch_region_sizes, cloudwatch_clients, region, bucket_names, storage_type_cache
+                ): region
+                for region, bucket_names in region_to_buckets.items()
+            }
+            for future in as_completed(futures):
+                region = futures[future]
+                sizes = future.result()
+                region_size = 0
+                for bucket_name, size in sizes.items():
+                    bucket_sizes.append({
+                        'name': bucket_name,
+                        'size': size,
+                        'region': region,
+                        'created': creation_dates[bucket_name]
+                    })
+                    region_size += size
+                region_stats[region] = {'count': len(sizes), 'size': region_size}
+                total_size += region_size
+                print(f"区域 {region} 已完成: {len(sizes)} 个存储桶")
             print()
         
+        # 只保留当前仍存在的存储桶，写回缓存
+        bucket_names = {bucket['Name'] for bucket in buckets}
+        save_json_cache(REGION_CACHE_FILE, {
+            name: region for name, region in region_cache.items()
+            if name in bucket_names
+        })
+        save_json_cache(STORAGE_TYPE_CACHE_FILE, {
+            name: entry for name, entry in storage_type_cache.items()
+            if name in bucket_names
+        })
+        
         # 输出结果
         print("=" * 60)
         print("统计结果")
@@ -187,25 +474,18 @@ def main():
         print()
         
         # 按大小排序
-        bucket_sizes.sort(key=lambda x: x['size'], reverse=True)
+        bucket_sizes.sort(key=itemgetter('size'), reverse=True)
         
         print("存储桶详情（按大小排序）:")
         print("-" * 60)
         for item in bucket_sizes:
-            print(f"存储桶: {item['name']}")
-            print(f"  区域: {item['region']}")
-            print(f"  大小: {format_size(item['size'])}")
-            print(f"  创建时间: {item['created'].strftime('%Y-%m-%d %H:%M:%S')}")
-            print()
-        
-        # 按区域统计
-        region_stats = {}
-        for item in bucket_sizes:
-            region = item['region']
-            if region not in region_stats:
-                region_stats[region] = {'count': 0, 'size': 0}
-            region_stats[region]['count'] += 1
-            region_stats[region]['size'] += item['size']
+            # 每个存储桶只调用一次print
+            print(
+                f"存储桶: {item['name']}\n"
+                f"  区域: {item['region']}\n"
+                f"  大小: {format_size(item['size'])}\n"
+                f"  创建时间: {item['created']:%Y-%m-%d %H:%M:%S}\n"
+            )
         
         print("=" * 60)
         print("按区域统计:")
@@ -5,10 +5,18 @@
 """
 
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+import hashlib
 import json
-import pandas as pd
+import os
+import random
+from openpyxl import Workbook, load_workbook
 from pathlib import Path
+import sqlite3
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # 配置
 EXCEL_FILE = "en-jp-猫咪乐园-claude3.7--日语反馈.xlsx"
@@ -16,59 +24,418 @@ SHEET_NAME = "Sheet1"  # 可根据需要修改
 SOURCE_COLUMN = "Content"  # 源文本列
 TARGET_COLUMN = "Claude Haiku 4.5"  # 翻译结果列（第8列）
 MODEL_ID = "us.anthropic.claude-haiku-4-5-20251001-v1:0"  # Claude Haiku 4.5
+SOURCE_LANG = "英语"  # 源语言
+TARGET_LANG = "日语"  # 目标语言
 REGION = "us-east-1"  # 根据您的区域修改
+MAX_TOKENS = 4096  # 每次请求的输出上限（整批译文共用）
+TEMPERATURE = 0.3
 
+# 批量翻译的提示词模板：段数、源语言、目标语言、JSON 数组形式的文本
+PROMPT_TEMPLATE = """请将以下{}段{}文本分别翻译成{}。
+文本以 JSON 字符串数组给出。只返回一个 JSON 字符串数组，按相同顺序包含每段的翻译结果，不要添加任何解释或额外内容。
 
-def translate_text(bedrock_client, text, source_lang="英语", target_lang="日语"):
+文本：
+{}
+
+JSON："""
+
+# 预先序列化请求体中不变的部分，每次请求只需转义提示词
+REQUEST_BODY_PREFIX = (
+    '{"anthropic_version": "bedrock-2023-05-31", '
+    f'"max_tokens": {MAX_TOKENS}, '
+    f'"temperature": {json.dumps(TEMPERATURE)}, '
+    '"messages": [{"role": "user", "content": '
+).encode("utf-8")
+REQUEST_BODY_SUFFIX = b'}]}'
+
+# 翻译结果缓存（SQLite），CACHE_MODE 可选：
+#   enabled  - 优先读取缓存，未命中时调用模型并写入缓存（默认）
+#   replay   - 只读取缓存，未命中时不调用模型
+#   disabled - 不使用缓存
+CACHE_FILE = "translate_cache.db"
+CACHE_MODES = ("enabled", "replay", "disabled")
+CACHE_MODE = os.environ.get("CACHE_MODE", "enabled")
+CACHE_COMMIT_INTERVAL = 50  # 每写入多少条提交一次，减少 fsync 次数
+
+# 并发与速率限制（根据账户的 Bedrock 配额调整）
+MAX_WORKERS = 16
+BATCH_SIZE = 10  # 每次请求合并翻译的最大行数（整批预计译文 token 数还需在 MAX_TOKENS 之内）
+REQUESTS_PER_MINUTE = 200
+TOKENS_PER_MINUTE = 200000
+
+# Bedrock 客户端配置：连接池大小与工作线程数匹配，复用长连接，自适应重试
+CLIENT_CONFIG = Config(
+    max_pool_connections=MAX_WORKERS,
+    retries={"mode": "adaptive", "max_attempts": 10},
+    tcp_keepalive=True
+)
+
+# 被限流时的重试次数（在客户端自适应重试之外），退避时间按 2^n 秒增长，最长 60 秒
+MAX_THROTTLE_RETRIES = 5
+# 视为限流的错误码（流式响应中的错误事件使用小写开头的错误码）
+THROTTLING_ERROR_CODES = {
+    "ThrottlingException",
+    "throttlingException",
+    "ServiceUnavailableException",
+    "serviceUnavailableException"
+}
+
+
+class RateLimiter:
     """
-    使用 Bedrock Claude 翻译文本
+    令牌桶速率限制器，同时限制每分钟请求数和每分钟 token 数
     """
-    if not text or pd.isna(text):
-        return ""
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.request_capacity = requests_per_minute
+        self.token_capacity = tokens_per_minute
+        self.request_tokens = float(requests_per_minute)
+        self.token_tokens = float(tokens_per_minute)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.request_tokens = min(
+            self.request_capacity,
+            self.request_tokens + elapsed * self.request_capacity / 60.0
+        )
+        self.token_tokens = min(
+            self.token_capacity,
+            self.token_tokens + elapsed * self.token_capacity / 60.0
+        )
+
+    def acquire(self, estimated_tokens):
+        """
+        阻塞直到可以发送一个预计消耗 estimated_tokens 的请求
+        """
+        estimated_tokens = min(estimated_tokens, self.token_capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.request_tokens >= 1 and self.token_tokens >= estimated_tokens:
+                    self.request_tokens -= 1
+                    self.token_tokens -= estimated_tokens
+                    return
+                # 计算需要等待的时间
+                wait = max(
+                    (1 - self.request_tokens) * 60.0 / self.request_capacity,
+                    (estimated_tokens - self.token_tokens) * 60.0 / self.token_capacity
+                )
+            time.sleep(wait)
+
+
+class TranslationCache:
+    """
+    以 SHA256 为键的翻译结果缓存，支持中断后恢复
+    """
+
+    def __init__(self, path, mode="enabled"):
+        self.mode = mode
+        self.conn = None
+        self.pending = 0
+        self.lock = threading.Lock()
+        if mode == "disabled":
+            return
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache(key TEXT PRIMARY KEY, response TEXT)"
+        )
+        self.conn.commit()
+
+    def get(self, key):
+        """
+        查询缓存，未命中返回 None
+        """
+        if self.conn is None:
+            return None
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT response FROM cache WHERE key=?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, response):
+        """
+        写入缓存（replay / disabled 模式下不写入）
+        """
+        if self.conn is None or self.mode != "enabled":
+            return
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cache(key, response) VALUES (?, ?)",
+                (key, response)
+            )
+            self.pending += 1
+            if self.pending >= CACHE_COMMIT_INTERVAL:
+                self.conn.commit()
+                self.pending = 0
+
+    def close(self):
+        """
+        提交未写入的记录并关闭数据库
+        """
+        if self.conn is None:
+            return
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
+
+
+def cache_key(text, source_lang, target_lang):
+    """
+    根据模型参数和源文本计算缓存键
+    """
+    raw = f"{MODEL_ID}|{TEMPERATURE}|{MAX_TOKENS}|{source_lang}|{target_lang}|{text}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def estimate_tokens(texts):
+    """
+    估计一次翻译请求占用的 token 配额
     
-    prompt = f"""请将以下{source_lang}文本翻译成{target_lang}。
-只返回翻译结果，不要添加任何解释或额外内容。
+    Bedrock 在请求开始时按 输入 token + max_tokens 预扣 TPM 配额，
+    因此输出部分按 MAX_TOKENS 计，输入部分按每字符约 1 token 粗略估计
+    """
+    return sum(len(str(text)) for text in texts) + 200 + MAX_TOKENS
 
-文本：
-{text}
-
-翻译："""
-    
-    # 构建请求体
-    request_body = {
-        "anthropic_version": "bedrock-2023-05-31",
-        "max_tokens": 4096,
-        "messages": [
-            {
-                "role": "user",
-                "content": prompt
-            }
-        ],
-        "temperature": 0.3
-    }
+
+def estimate_output_tokens(text):
+    """
+    粗略估计一段文本译文的输出 token 数（按每个源字符约 1 token，外加 JSON 引号和分隔符）
+    """
+    return len(str(text)) + 10
+
+
+def make_batches(texts):
+    """
+    将文本按顺序切分为连续的批次：每批最多 BATCH_SIZE 行，
+    且预计输出 token 数之和不超过 MAX_TOKENS（单行超出时单独成批）
     
+    返回 (起始下标, 结束下标) 列表
+    """
+    batches = []
+    start = 0
+    budget = 0
+    for i, text in enumerate(texts):
+        tokens = estimate_output_tokens(text)
+        if i > start and (i - start >= BATCH_SIZE or budget + tokens > MAX_TOKENS):
+            batches.append((start, i))
+            start = i
+            budget = 0
+        budget += tokens
+    if start < len(texts):
+        batches.append((start, len(texts)))
+    return batches
+
+
+def parse_translations(output, expected_count):
+    """
+    从模型输出中解析 JSON 字符串数组，数量不符时返回 None
+    """
+    start = output.find("[")
+    end = output.rfind("]")
+    if start == -1 or end <= start:
+        return None
     try:
-        # 调用 Bedrock API
-        response = bedrock_client.invoke_model(
-            modelId=MODEL_ID,
-            body=json.dumps(request_body)
-        )
+        translations = json.loads(output[start:end + 1])
+    except ValueError:
+        return None
+    if not isinstance(translations, list) or len(translations) != expected_count:
+        return None
+    return [str(t).strip() for t in translations]
+
+
+def read_stream_text(response):
+    """
+    读取 invoke_model_with_response_stream 的事件流，拼接所有文本增量
+    
+    返回 (文本, stop_reason)，输出达到 max_tokens 被截断时 stop_reason 为 "max_tokens"
+    """
+    parts = []
+    stop_reason = None
+    for event in response['body']:
+        chunk = event.get('chunk')
+        if not chunk:
+            continue
+        data = json.loads(chunk['bytes'])
+        if data.get('type') == 'content_block_delta':
+            parts.append(data['delta'].get('text', ''))
+        elif data.get('type') == 'message_delta':
+            stop_reason = data['delta'].get('stop_reason', stop_reason)
+    return "".join(parts), stop_reason
+
+
+def translate_text(bedrock_client, texts, source_lang=SOURCE_LANG, target_lang=TARGET_LANG, rate_limiter=None):
+    """
+    使用 Bedrock Claude 在一次请求中批量翻译多段文本
+    
+    每次请求前从 rate_limiter 获取令牌；被限流时指数退避后重试
+    返回与 texts 顺序一致的译文列表
+    """
+    if not texts:
+        return []
+    
+    prompt = PROMPT_TEMPLATE.format(
+        len(texts), source_lang, target_lang, json.dumps(texts, ensure_ascii=False)
+    )
+    
+    # 构建请求体：只有提示词需要每次序列化
+    request_body = (
+        REQUEST_BODY_PREFIX
+        + json.dumps(prompt, ensure_ascii=False).encode("utf-8")
+        + REQUEST_BODY_SUFFIX
+    )
+    
+    estimated_tokens = estimate_tokens(texts)
+    attempt = 0
+    while True:
+        if rate_limiter is not None:
+            rate_limiter.acquire(estimated_tokens)
+        try:
+            # 调用 Bedrock 流式 API，边接收边解析
+            response = bedrock_client.invoke_model_with_response_stream(
+                modelId=MODEL_ID,
+                body=request_body
+            )
+            output, stop_reason = read_stream_text(response)
+            output = output.strip()
+            break
         
-        # 解析响应
-        response_body = json.loads(response['body'].read())
-        translated_text = response_body['content'][0]['text'].strip()
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code in THROTTLING_ERROR_CODES and attempt < MAX_THROTTLE_RETRIES:
+                delay = min(2 ** attempt, 60) + random.random()
+                attempt += 1
+                print(f"请求被限流 ({code})，{delay:.1f} 秒后重试 ({attempt}/{MAX_THROTTLE_RETRIES})")
+                time.sleep(delay)
+                continue
+            print(f"翻译出错: {str(e)}")
+            return [f"ERROR: {str(e)}"] * len(texts)
         
-        return translated_text
+        except Exception as e:
+            print(f"翻译出错: {str(e)}")
+            return [f"ERROR: {str(e)}"] * len(texts)
     
-    except Exception as e:
-        print(f"翻译出错: {str(e)}")
-        return f"ERROR: {str(e)}"
+    # 输出被 max_tokens 截断：将批次对半拆分后分别重试
+    if stop_reason == "max_tokens":
+        if len(texts) > 1:
+            middle = len(texts) // 2
+            print(f"批量译文超出 max_tokens，拆分为 {middle} + {len(texts) - middle} 段重试")
+            return (
+                translate_text(bedrock_client, texts[:middle], source_lang, target_lang, rate_limiter)
+                + translate_text(bedrock_client, texts[middle:], source_lang, target_lang, rate_limiter)
+            )
+        print("译文超出 max_tokens")
+        return [f"ERROR: 译文超出 max_tokens ({MAX_TOKENS})"]
+    
+    translations = parse_translations(output, len(texts))
+    if translations is not None:
+        return translations
+    
+    # 批量结果无法解析时逐条重试
+    if len(texts) > 1:
+        print(f"批量翻译结果无法解析，逐条重试 {len(texts)} 段文本")
+        return [
+            translate_text(bedrock_client, [text], source_lang, target_lang, rate_limiter)[0]
+            for text in texts
+        ]
+    
+    print("翻译结果无法解析")
+    return [f"ERROR: 无法解析翻译结果: {output[:100]}"]
+
+
+def translate_batch(bedrock_client, rate_limiter, cache, texts):
+    """
+    在工作线程中翻译一批文本：优先读取缓存，未命中的文本合并为一次模型调用
+    
+    replay 模式下未命中缓存的文本返回 None
+    """
+    keys = [cache_key(text, SOURCE_LANG, TARGET_LANG) for text in texts]
+    results = [cache.get(key) for key in keys]
+    
+    missing = [i for i, result in enumerate(results) if result is None]
+    if not missing:
+        return results
+    if cache.mode == "replay":
+        return results
+    
+    missing_texts = [str(texts[i]) for i in missing]
+    translations = translate_text(
+        bedrock_client, missing_texts, SOURCE_LANG, TARGET_LANG, rate_limiter
+    )
+    
+    for i, translated in zip(missing, translations):
+        results[i] = translated
+        if not translated.startswith("ERROR:"):
+            cache.put(keys[i], translated)
+    return results
+
+
+def read_source_texts(ws):
+    """
+    流式读取工作表，只保留源列中需要翻译的文本
+    
+    返回 (数据行数, 需要翻译的行号列表, 对应文本列表)，找不到源列时返回 None
+    """
+    rows = ws.iter_rows(values_only=True)
+    header = list(next(rows, ()))
+    if SOURCE_COLUMN not in header:
+        print(f"错误：找不到列 '{SOURCE_COLUMN}'")
+        print(f"可用的列: {header}")
+        return None
+    source_idx = header.index(SOURCE_COLUMN)
+    
+    total_rows = 0
+    row_numbers = []
+    texts = []
+    for row_number, row in enumerate(rows):
+        total_rows += 1
+        value = row[source_idx] if source_idx < len(row) else None
+        # 跳过空值
+        if value is None or str(value).strip() == "":
+            continue
+        row_numbers.append(row_number)
+        texts.append(str(value))
+    return total_rows, row_numbers, texts
+
+
+def write_translated_workbook(ws, output_path, translations):
+    """
+    以 write-only 模式流式写出结果：逐行复制源工作表并填入译文
+    """
+    out_wb = Workbook(write_only=True)
+    out_ws = out_wb.create_sheet(SHEET_NAME)
+    
+    rows = ws.iter_rows(values_only=True)
+    header = list(next(rows, ()))
+    if TARGET_COLUMN not in header:
+        header.append(TARGET_COLUMN)
+    target_idx = header.index(TARGET_COLUMN)
+    out_ws.append(header)
+    
+    for row_number, row in enumerate(rows):
+        row = list(row) + [None] * (len(header) - len(row))
+        if row_number in translations:
+            row[target_idx] = translations[row_number]
+        out_ws.append(row)
+    
+    out_wb.save(output_path)
 
 
 def main():
     """
     主函数
     """
+    # 检查缓存模式
+    if CACHE_MODE not in CACHE_MODES:
+        print(f"错误：无效的 CACHE_MODE {CACHE_MODE!r}")
+        print(f"可用的模式: {list(CACHE_MODES)}")
+        return
+    
     # 检查文件是否存在
     excel_path = Path(EXCEL_FILE)
     if not excel_path.exists():
@@ -77,85 +444,112 @@ def main():
     
     print(f"正在读取 Excel 文件: {EXCEL_FILE}")
     
-    # 读取 Excel 文件
+    # 以只读模式流式读取 Excel 文件
     try:
-        df = pd.read_excel(excel_path, sheet_name=SHEET_NAME)
+        workbook = load_workbook(excel_path, read_only=True, data_only=True)
     except Exception as e:
-        print(f"读取 Excel 文件失败: {str(e)}")
-        # 尝试读取第一个 sheet
-        try:
-            df = pd.read_excel(excel_path)
-            print("使用默认 sheet")
-        except Exception as e2:
-            print(f"无法读取文件: {str(e2)}")
-            return
-    
-    print(f"读取到 {len(df)} 行数据")
-    
-    # 检查源列是否存在
-    if SOURCE_COLUMN not in df.columns:
-        print(f"错误：找不到列 '{SOURCE_COLUMN}'")
-        print(f"可用的列: {list(df.columns)}")
+        print(f"无法读取文件: {str(e)}")
         return
     
-    # 初始化 Bedrock 客户端
-    print(f"初始化 AWS Bedrock 客户端 (区域: {REGION})")
     try:
-        bedrock_client = boto3.client(
-            service_name='bedrock-runtime',
-            region_name=REGION
-        )
-    except Exception as e:
-        print(f"初始化 Bedrock 客户端失败: {str(e)}")
-        print("请确保已配置 AWS 凭证 (aws configure)")
-        return
-    
-    # 确保目标列存在
-    if TARGET_COLUMN not in df.columns:
-        df[TARGET_COLUMN] = ""
-    
-    # 翻译每一行
-    total_rows = len(df)
-    translated_count = 0
-    
-    print(f"\n开始翻译，使用模型: {MODEL_ID}")
-    print("-" * 60)
-    
-    for index, row in df.iterrows():
-        source_text = row[SOURCE_COLUMN]
+        if SHEET_NAME in workbook.sheetnames:
+            ws = workbook[SHEET_NAME]
+        else:
+            # 尝试读取第一个 sheet
+            print(f"找不到工作表 '{SHEET_NAME}'，使用默认 sheet")
+            ws = workbook.worksheets[0]
         
-        # 跳过空值
-        if pd.isna(source_text) or str(source_text).strip() == "":
-            continue
+        source = read_source_texts(ws)
+        if source is None:
+            return
+        total_rows, row_numbers, texts = source
         
-        print(f"[{index + 1}/{total_rows}] 翻译中...")
-        print(f"源文本: {str(source_text)[:50]}...")
+        print(f"读取到 {total_rows} 行数据")
         
-        # 调用翻译
-        translated = translate_text(bedrock_client, source_text)
-        df.at[index, TARGET_COLUMN] = translated
+        # 初始化 Bedrock 客户端
+        print(f"初始化 AWS Bedrock 客户端 (区域: {REGION})")
+        try:
+            session = boto3.session.Session()
+            bedrock_client = session.client(
+                service_name='bedrock-runtime',
+                region_name=REGION,
+                config=CLIENT_CONFIG
+            )
+        except Exception as e:
+            print(f"初始化 Bedrock 客户端失败: {str(e)}")
+            print("请确保已配置 AWS 凭证 (aws configure)")
+            return
         
-        print(f"译文: {translated[:50]}...")
-        print()
+        processed_count = 0
+        translated_count = 0
         
-        translated_count += 1
+        print(f"\n开始翻译，使用模型: {MODEL_ID}")
+        print("-" * 60)
+        print(f"需要翻译 {len(texts)} / {total_rows} 行")
         
-        # 添加延迟以避免速率限制
-        time.sleep(0.5)
-    
-    # 保存结果
-    output_file = excel_path.stem + "_translated.xlsx"
-    output_path = excel_path.parent / output_file
-    
-    print("-" * 60)
-    print(f"保存翻译结果到: {output_path}")
-    
-    try:
-        df.to_excel(output_path, sheet_name=SHEET_NAME, index=False)
-        print(f"✓ 成功翻译 {translated_count} 条记录")
-        print(f"✓ 结果已保存到: {output_path}")
-    except Exception as e:
-        print(f"保存文件失败: {str(e)}")
+        # 并发翻译，由令牌桶控制速率
+        rate_limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+        cache = TranslationCache(CACHE_FILE, CACHE_MODE)
+        print(f"翻译缓存: {CACHE_FILE} (模式: {CACHE_MODE})")
+        results = [None] * len(texts)
+        
+        try:
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                # 按行数和输出 token 预算分批，每批一次模型调用
+                futures = {
+                    executor.submit(
+                        translate_batch, bedrock_client, rate_limiter, cache,
+                        texts[start:stop]
+                    ): start
+                    for start, stop in make_batches(texts)
+                }
+                try:
+                    for future in as_completed(futures):
+                        start = futures[future]
+                        translations = future.result()
+                        results[start:start + len(translations)] = translations
+                        processed_count += len(translations)
+                        # 只统计真正得到译文的行（不含 replay 未命中和出错的行）
+                        translated_count += sum(
+                            1 for t in translations
+                            if t is not None and not t.startswith("ERROR:")
+                        )
+                        print(f"[{processed_count}/{len(texts)}] 翻译完成")
+                except KeyboardInterrupt:
+                    # 中断（如 Ctrl-C）时取消尚未开始的批次，避免继续调用付费 API
+                    print("\n已中断：取消未开始的批次，等待进行中的批次完成...")
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
+                except Exception as e:
+                    print(f"\n翻译批次出错，取消未开始的批次: {str(e)}")
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
+        finally:
+            # 中断时不会写出结果文件，但所有已完成批次（含中断时进行中的批次）
+            # 的译文会在这里提交到缓存，重新运行即可从缓存继续
+            cache.close()
+        
+        # 保存结果
+        output_file = excel_path.stem + "_translated.xlsx"
+        output_path = excel_path.parent / output_file
+        
+        print("-" * 60)
+        print(f"保存翻译结果到: {output_path}")
+        
+        try:
+            # 没有译文的行保留源文件中目标列的原值
+            translations = {
+                row_number: result
+                for row_number, result in zip(row_numbers, results)
+                if result is not None
+            }
+            write_translated_workbook(ws, output_path, translations)
+            print(f"✓ 成功翻译 {translated_count} 条记录")
+            print(f"✓ 结果已保存到: {output_path}")
+        except Exception as e:
+            print(f"保存文件失败: {str(e)}")
+    finally:
+        workbook.close()
 
 
 if __name__ == "__main__":